@@ -15,53 +15,308 @@ Author: Noah Putna.
 
 # -- Import Statements -- 
 
-from typing import Dict, List
+import copy
+import math
+import os
+import statistics
+import time
+from collections import deque
+from typing import Dict, List, MutableSequence
 from fmclient import Agent, Session, Order, OrderSide, OrderType, Holding
-import numpy as np 
+
+# Rejection reason reported by the exchange when an order cannot be covered.
+_INSUFFICIENT_ASSETS = "ORDER_INSUFFICIENT_ASSETS"
+
+# Numba is an opt-in (use_numba=True) - by default the scoring kernel runs as plain Python over lists.
+# Numba and NumPy are only imported when opted into, keeping the default start-up light.
+np = None
+
+# Signature the Numba kernel is compiled for up front: (utility, price, active) -> (index, score).
+_BEST_SIGNATURE = "Tuple((int64, float64))(float64[::1], float64[::1], boolean[::1])"
+
+# -- Scoring Kernel
+
+def _as_list(values, dtype=float):
+    """ Build a plain list - the default vector type, fastest for the interpreted kernel. """
+    return [dtype(v) for v in values]
+
+def _as_array(values, dtype=float):
+    """ Build a contiguous typed array the compiled kernel can consume. """
+    return np.array(values, dtype=dtype)
+
+def _best(utility, price, active):
+    """ Return the index and score of the asset with the highest CAPM score (utility - price).
+    Inactive assets are skipped; returns (-1, -inf) if no asset is active.
+
+    Assets must be sorted by utility in descending order: as prices are non-negative, an asset's
+    score can never exceed its utility, so the scan stops once utility falls to the best score. """
+
+    best = -math.inf
+    k = -1
+    for i in range(len(utility)):
+        if utility[i] <= best:
+            break
+        if not active[i]:
+            continue
+        s = utility[i] - price[i]
+        if s > best:
+            best = s
+            k = i
+    return k, best
+
+_best_jit = None
+
+def _compile_best():
+    """ Import Numba and compile _best for _BEST_SIGNATURE, once per process.
+    Returns None if Numba is not installed. """
+
+    global _best_jit, np
+    if _best_jit is None:
+        try:
+            from numba import njit
+            import numpy
+        except ImportError:
+            return None
+        np = numpy
+        _best_jit = njit(_BEST_SIGNATURE, cache=True)(_best)
+    return _best_jit
 
 # -- CAPMBot Class Definition
 
 class CAPMBot(Agent):
     """A trading agent that implements a CAPM-based utility function to decide trades."""
 
-    def __init__(self, account, email, password, marketplace_id, risk_aversion = 0.5):
+    # Fixed attribute layout - avoids a per-instance dict probe on every hot-path attribute read.
+    # (Agent itself may still carry a __dict__ for its own state.)
+    __slots__ = (
+        "_risk_aversion", "_base_risk_aversion", "_payoffs", "_market_ids",
+        "use_numba", "_kernel", "_vector",
+        "_asset_names", "_markets_list", "_order_templates", "_templates_list",
+        "_exp_arr", "_var_arr", "_utility_const", "_prices", "_active",
+        "_last_sig", "_note_idx", "_note_template",
+        "holdings", "cash_threshold", "note_discount",
+        "log_interval", "_last_cash", "_last_cash_log_ts", "_last_afford_log_ts",
+        "target_variance", "retune_interval", "_recent_pnl", "_last_wealth", "_holdings_ticks",
+    )
+
+    def __init__(self, account, email, password, marketplace_id, risk_aversion = 0.5, target_variance = None,
+                 use_numba = False):
         """Initialise the CAPMBot with account credentials and trading settings."""
 
         # Initialise bot and commence trading.
         super().__init__(account, email, password, marketplace_id, name="CAPM Bot")
 
-        # Risk aversion parameter used in utility equation.
-        self.risk_aversion = risk_aversion
+        # Risk aversion parameter used in utility equation (see the risk_aversion property).
+        self._risk_aversion = risk_aversion
+
+        # Configured λ that auto-tuning scales from, so retuning never discards the user's setting.
+        self._base_risk_aversion = risk_aversion
+
+        # Scoring kernel and matching vector type - plain Python over lists unless Numba is opted into.
+        self.use_numba = use_numba
+        self._kernel = _best
+        self._vector = _as_list
 
         # Stores expected payoff distributions and market references.
         self._payoffs: Dict[str, List[int]] = {}
         self._market_ids: Dict[str, object] = {}
 
+        # Struct-of-arrays view of the markets, aligned by asset index. The hot path works on
+        # indices only - asset names are looked up for logging and holdings.
+        # Payoffs never change after initialisation, so their statistics are computed once.
+        self._asset_names: List[str] = []
+        self._markets_list: List[object] = []
+        self._exp_arr: MutableSequence[float] = self._vector([])
+        self._var_arr: MutableSequence[float] = self._vector([])
+
+        # Precomputed utility per asset: expectation - λ * variance. Constant until λ changes.
+        self._utility_const: MutableSequence[float] = None
+
+        # Per-tick price and activity buffers, allocated once and refilled in place.
+        self._prices: MutableSequence[float] = self._vector([])
+        self._active: MutableSequence[bool] = self._vector([], bool)
+
+        # Market signature seen on the previous tick, used to skip redundant evaluations.
+        self._last_sig: tuple = None
+
+        # Index of the Note market used for liquidity management (-1 if absent).
+        self._note_idx = -1
+
+        # Pre-configured limit order templates keyed by asset name, the same templates aligned by asset index,
+        # plus one for note liquidation.
+        self._order_templates: Dict[str, Order] = {}
+        self._templates_list: List[Order] = []
+        self._note_template: Order = None
+
         # Current holdings (cash and assets).
         self.holdings: Holding = None
 
         # Parameters for liquidity management.
         self.cash_threshold = 10
         self.note_discount = 2
+
+        # Minimum number of seconds between repeated hot-path log messages.
+        self.log_interval = 1.0
+
+        # State used to skip logging when nothing has changed or a message was just sent.
+        self._last_cash = None
+        self._last_cash_log_ts = 0.0
+        self._last_afford_log_ts = 0.0
+
+        # Risk aversion auto-tuning: λ tracks realised PnL variance relative to the target.
+        # Disabled when target_variance is None.
+        self.target_variance = target_variance
+        self.retune_interval = 50
+        self._recent_pnl = deque(maxlen=100)
+        self._last_wealth = None
+        self._holdings_ticks = 0
     
+    @property
+    def risk_aversion(self):
+        """ Risk aversion parameter (λ) used in the utility equation. """
+        return self._risk_aversion
+
+    @risk_aversion.setter
+    def risk_aversion(self, value):
+        """ Update λ (and the base λ used by auto-tuning) and recompute the cached utilities
+        so trading decisions reflect it immediately. """
+        self._risk_aversion = value
+        self._base_risk_aversion = value
+
+        # Before initialisation there are no utilities to refresh - initialised() computes them.
+        if self._utility_const is not None:
+            self._update_utility()
+
+    def retune(self):
+        """ Adjust λ to the observed market: the configured (base) λ scaled by realised PnL variance
+        over the target variance, clamped to [0.1, 2.0]. Does nothing until enough PnL samples are recorded. """
+
+        if self.target_variance is None or len(self._recent_pnl) < 2:
+            return
+
+        realised_variance = statistics.pvariance(self._recent_pnl)
+        if realised_variance <= 0:
+            return
+
+        # Bypass the property setter so the base λ is kept for the next retune.
+        scale = realised_variance / self.target_variance
+        self._risk_aversion = min(2.0, max(0.1, self._base_risk_aversion * scale))
+        self._update_utility()
+        self.inform(f"Risk aversion retuned to {self.risk_aversion:.3f}.")
+
+    def _record_pnl(self, holdings: Holding):
+        """ Record the change in marked-to-expectation wealth since the last holdings update.
+        Total cash is used, as available cash also moves when buy orders rest or are cancelled. """
+
+        # Asset values are unknown until initialisation, so earlier updates would skew the baseline.
+        if self._utility_const is None:
+            return
+
+        wealth = holdings.cash + sum(
+            holdings.get(asset, 0) * expectation for asset, expectation in zip(self._asset_names, self._exp_arr)
+        )
+        if self._last_wealth is not None:
+            self._recent_pnl.append(wealth - self._last_wealth)
+        self._last_wealth = wealth
+
+    def _update_utility(self):
+        """ Recompute the per-asset utility vector: expected payoff - λ * variance.
+        The parallel asset arrays are re-sorted by descending utility so the scoring kernel can stop early. """
+
+        lam = self._risk_aversion
+        utility = [e - lam * v for e, v in zip(self._exp_arr, self._var_arr)]
+        order = sorted(range(len(utility)), key=utility.__getitem__, reverse=True)
+
+        self._asset_names = [self._asset_names[i] for i in order]
+        self._markets_list = [self._markets_list[i] for i in order]
+        self._templates_list = [self._templates_list[i] for i in order]
+        self._exp_arr = self._vector([self._exp_arr[i] for i in order])
+        self._var_arr = self._vector([self._var_arr[i] for i in order])
+        self._utility_const = self._vector([utility[i] for i in order])
+
+        # Re-derive the Note index for the new order.
+        self._note_idx = self._asset_names.index("Note") if "Note" in self._asset_names else -1
+
     def initialised(self):
         """Called when the bot is connected and initialised. Assigns market referenes and descriptions."""
 
-        try:
-            # Extract payoff distributions and associate market ID's with asset names.
-            for market_id, market in self.markets.items():
-                item = market.item
-                self._payoffs[item] = [int(x) for x in market.description.split(",")]
-
-                # Store a reference to the market object keyed by asset name.
-                self._market_ids[item] = market
-            
-            # Log confirmation of successful initialisation.
-            self.inform("Bot initialised.")
+        # Start from a clean slate so initialisation can safely run again (e.g. on reconnect).
+        self._payoffs = {}
+        self._market_ids = {}
+        self._order_templates = {}
+        self._note_template = None
 
-        except Exception as e:
-            #Catch and log unexpected initialisation errors.
-            self.error(f"Error during initialisation: {e}")
+        # Extract payoff distributions and associate market ID's with asset names.
+        for market_id, market in self.markets.items():
+            item = market.item
+
+            # Set up each market on its own, so one failure (e.g. a malformed description) only drops that asset.
+            try:
+                payoffs = list(map(int, market.description.split(",")))
+
+                # Prepare a 1-unit limit order template so submissions only set side and price.
+                order = Order.create_new(market)
+                order.order_type = OrderType.LIMIT
+                order.units = 1
+                order.ref = "main_order"
+
+            except Exception as e:
+                self.error(f"Skipping market {item}: {e}")
+                continue
+
+            self._payoffs[item] = payoffs
+
+            # Store a reference to the market object keyed by asset name.
+            self._market_ids[item] = market
+            self._order_templates[item] = order
+
+        # Build parallel arrays so all assets can be scored in a single vectorised pass.
+        self._asset_names = list(self._market_ids)
+        self._markets_list = list(self._market_ids.values())
+        self._templates_list = list(self._order_templates.values())
+
+        # Compile the Numba kernel up front when opted in, so the first tick does not pay for it.
+        if self.use_numba:
+            try:
+                kernel = _compile_best()
+            except Exception as e:
+                self.error(f"Failed to compile Numba kernel: {e}")
+                kernel = None
+            if kernel is None:
+                self.error("Numba is not installed - using the pure Python kernel.")
+            else:
+                self._kernel = kernel
+                self._vector = _as_array
+
+        # Allocate the per-tick buffers once, sized to the number of markets.
+        self._prices = self._vector([0.0] * len(self._markets_list))
+        self._active = self._vector([False] * len(self._markets_list), bool)
+
+        # Compute CAPM metrics once per asset - payoff lists are tiny, so pure Python suffices.
+        stats = [self.calculate_expectation_and_variance(a) for a in self._asset_names]
+        self._exp_arr = self._vector([e for e, _ in stats])
+        self._var_arr = self._vector([v for _, v in stats])
+
+        # Fold the risk penalty into a single per-asset utility vector (also assigns asset indices).
+        self._update_utility()
+
+        # Prepare the note liquidation template - only the price changes between submissions.
+        if self._note_idx >= 0:
+            try:
+                order = Order.create_new(self._markets_list[self._note_idx])
+                order.order_type = OrderType.LIMIT
+                order.order_side = OrderSide.SELL
+                order.units = 1
+                order.ref = "note_liquidation"
+                self._note_template = order
+            except Exception as e:
+                self.error(f"Failed to prepare note liquidation order: {e}")
+
+        # Log confirmation of successful initialisation - or warn if there is nothing to trade.
+        if self._markets_list:
+            self.inform("Bot initialised.")
+        else:
+            self.error("Bot initialised with no tradable markets - no orders will be placed.")
     
     def received_holdings(self, holdings: Holding):
         """Store and log current cash and asset holdings."""
@@ -69,8 +324,21 @@ class CAPMBot(Agent):
         # Store the latest holdings and information from the server.
         self.holdings = holdings
 
-        # Log the available cash to console.
-        self.inform(f"Cash available: {holdings.cash_available}")
+        # Track realised PnL and periodically retune risk aversion to it.
+        if self.target_variance is not None:
+            self._record_pnl(holdings)
+            self._holdings_ticks += 1
+            if self._holdings_ticks % self.retune_interval == 0:
+                self.retune()
+
+        # Log the available cash to console - only when it has changed, and at most once per interval.
+        cash = holdings.cash_available
+        if cash != self._last_cash:
+            now = time.monotonic()
+            if now - self._last_cash_log_ts > self.log_interval:
+                self.inform(f"Cash available: {cash}")
+                self._last_cash_log_ts = now
+                self._last_cash = cash
     
     def received_session_info(self, session: Session):
         """Respond to session status updates (open or closed)."""
@@ -81,6 +349,9 @@ class CAPMBot(Agent):
         else:
             self.inform("Session closed.")
 
+        # Session boundaries are a natural point to retune risk aversion.
+        self.retune()
+
     def order_accepted(self, order: Order):
         """Handle successful order submission and log it."""
 
@@ -90,11 +361,14 @@ class CAPMBot(Agent):
     def order_rejected(self, info, order: Order):
         """Handle rejected orders with recovery strategy."""
 
+        # Render the rejection reason once and reuse it for logging and matching.
+        reason = str(info)
+
         # Log the rejection reason for debugging purposes.
-        self.error(f"Order rejected: {info}")
+        self.error("Order rejected: " + reason)
 
         # Attempt to raise cash by selling notes - if order was rejected due to lack of cash.
-        if 'ORDER_INSUFFICIENT_ASSETS' in str(info):
+        if _INSUFFICIENT_ASSETS in reason:
             self.inform("Attempting to raise cash.")
             self.raise_cash_via_notes()
     
@@ -105,82 +379,93 @@ class CAPMBot(Agent):
         # Wait until holdings are available before making decisions.
         if not self.holdings:
             return
+
+        # Skip evaluation if no price, order book depth or available cash has changed since the last tick.
+        sig = (self.holdings.cash_available,) + tuple((m.price, len(m.public_orders)) for m in self._markets_list)
+        if sig == self._last_sig:
+            return
+        self._last_sig = sig
         
         # Use CAPM logic to select the best asset to trade.
         optimal = self.select_best_asset()
 
         if optimal:
-            asset, side, price = optimal
+            idx, side, price = optimal
 
             # If cash amount is available, place the order. Otherwise, attempt to raise the cash by liquidating notes.
             if self.can_afford(side, price):
-                self.place_order(asset, side, price)
+                self.place_order(idx, side, price)
             else:
-                self.inform("Cannot afford optimal asset. Attempting to raise cash.")
+                now = time.monotonic()
+                if now - self._last_afford_log_ts > self.log_interval:
+                    self.inform("Cannot afford optimal asset. Attempting to raise cash.")
+                    self._last_afford_log_ts = now
                 self.raise_cash_via_notes()
 
     def calculate_expectation_and_variance(self, asset: str):
         """ Calculate the expected payoff and variance for an asset. """
 
-        # Equal probabilities for all payoff outcomes (uniform distribution).
-        payoffs = np.array(self._payoffs[asset])
-        probabilities = np.ones_like(payoffs) / len(payoffs)
+        # Payoff lists are tiny, so plain Python beats NumPy's dispatch and allocation overhead.
+        payoffs = self._payoffs[asset]
+        n = len(payoffs)
+
+        # Under equal probabilities (uniform distribution) both moments follow from one pass of sums.
+        total = sum(payoffs)
+        total_sq = sum(x * x for x in payoffs)
 
         # Compute expected value (mean).
-        expectation = np.dot(payoffs, probabilities)
+        expectation = total / n
 
-        # Compute variance: E[(X - E[X])^2].
-        variance = np.dot(probabilities, (payoffs - expectation) ** 2)
+        # Compute variance: E[X^2] - E[X]^2, kept in exact integer arithmetic until the final division.
+        variance = (n * total_sq - total * total) / (n * n)
 
-        return expectation, variance
+        return float(expectation), float(variance)
     
     def select_best_asset(self):
         """ Evalulate all assets and return the best candidate for trading based on the
-        CAPM utility score: expected payoff - λ * variance. """
-
-        best_score = float("-inf")
-        best_decision = None
-
-        for asset, market in self._market_ids.items():
-            # Skip assets with no active public orders.
-            if not market.public_orders:
-                continue
-            
-            # Compute CAPM metrics.
-            expectation, variance = self.calculate_expectation_and_variance(asset)
-            utility = expectation - self.risk_aversion * variance
+        CAPM utility score: expected payoff - λ * variance. Returns (asset index, side, price). """
+
+        if not self._markets_list or self._utility_const is None:
+            return None
+
+        # Snapshot current prices and which markets have active public orders, reusing the same buffers.
+        prices = self._prices
+        active = self._active
+        if self._vector is _as_array:
+            # Bulk slice assignment is cheaper than per-element writes into NumPy arrays.
+            prices[:] = [market.price for market in self._markets_list]
+            active[:] = [bool(market.public_orders) for market in self._markets_list]
+        else:
+            # Plain lists are filled in place, so the default path allocates nothing per tick.
+            for i, market in enumerate(self._markets_list):
+                prices[i] = market.price
+                active[i] = bool(market.public_orders)
 
-            current_price = market.price
+        # Score every asset in a single pass, skipping assets with no active public orders.
+        i, best_score = self._kernel(self._utility_const, prices, active)
 
-            # Only consider assets where utility exceeds current market price.
-            if utility > current_price:
-                score = utility - current_price
-                if score > best_score:
-                    best_score = score
-                    best_decision = (asset, OrderSide.BUY, int(current_price))
+        # Only consider assets where utility exceeds current market price.
+        if i >= 0 and best_score > 0:
+            return (int(i), OrderSide.BUY, int(prices[i]))
 
-        return best_decision
+        return None
     
     def can_afford(self, side: OrderSide, price: int):
         """ Check whether the bot can afford the order based on available cash."""
 
-        if side == OrderSide.BUY:
-            return self.holdings.cash_available >= price
-        return True
+        # Branchless form of: BUY needs cash >= price, SELL is always affordable.
+        # For SELL the required cash becomes price * False == 0, so the check always passes.
+        return self.holdings.cash_available >= price * (side == OrderSide.BUY)
     
-    def place_order(self, asset: str, side: OrderSide, price: int):
+    def place_order(self, idx: int, side: OrderSide, price: int):
         """ Submit a limit order to the market. """
 
         try:
-            # Create a new order object for relevant market.
-            order = Order.create_new(self._market_ids[asset])
-
-            # Set order parameters to define it as a limit order with 1 unit.
-            order.order_type = OrderType.LIMIT
+            # Copy the pre-configured 1-unit limit order for the relevant market.
+            # A fresh copy is sent each time, as the client may hold on to submitted orders.
+            order = copy.copy(self._templates_list[idx])
             order.order_side = side
             order.price = price
-            order.units = 1
-            order.ref = "main_order"
 
             # Send the order to the market.
             self.send_order(order)
@@ -194,24 +479,20 @@ class CAPMBot(Agent):
         This acts as a liquidity safeguard."""
 
         # Check if notes exist and are available for sale.
-        if "Note" not in self._market_ids or self.holdings.get("Note", 0) <= 0:
+        if self._note_template is None or self.holdings.get("Note", 0) <= 0:
             self.inform("No notes available to sell.")
             return
 
         try:
-            # Access the market object for notes.
-            market = self._market_ids["Note"]
+            # Access the cached market object for notes.
+            market = self._markets_list[self._note_idx]
 
             # Determine a discounted price to increase chance of sale.
             price = max(1, market.price - self.note_discount)
 
-            # Prepare a new sell order for one unit of notes.
-            order = Order.create_new(market)
-            order.order_type = OrderType.LIMIT
-            order.order_side = OrderSide.SELL
+            # Copy the pre-configured sell order for one unit of notes.
+            order = copy.copy(self._note_template)
             order.price = price
-            order.units = 1
-            order.ref = "note_liquidation"
 
             # Send the order to the market to raise cash.
             self.send_order(order)
@@ -226,12 +507,23 @@ if __name__ == "__main__":
     Instantiates and runs the trading bot with user-defined credentials and settings.
 
     SECURITY INFORMATION:
-    Avoid harcoding credentials - replace FM_EMAIL and FM_PASSWORD with environment variables. """
+    Avoid harcoding credentials - replace FM_EMAIL and FM_PASSWORD with environment variables.
+
+    Risk settings can be overridden with CAPM_RISK_AVERSION and CAPM_TARGET_VARIANCE
+    (setting the latter enables risk aversion auto-tuning). Set CAPM_USE_NUMBA=1 to opt into
+    the Numba-compiled scoring kernel. """
 
     FM_ACCOUNT = "regular-idol"
     FM_EMAIL = "FM_EMAIL"       # Replace with environment variable in real use.
     FM_PASSWORD = "FM_PASSWORD" # Replace with environment variable in real use.
     MARKETPLACE_ID = 1181
 
-    bot = CAPMBot(FM_ACCOUNT, FM_EMAIL, FM_PASSWORD, MARKETPLACE_ID)
+    RISK_AVERSION = float(os.getenv("CAPM_RISK_AVERSION", "0.5"))
+    TARGET_VARIANCE = os.getenv("CAPM_TARGET_VARIANCE")
+    TARGET_VARIANCE = float(TARGET_VARIANCE) if TARGET_VARIANCE else None
+
+    USE_NUMBA = os.getenv("CAPM_USE_NUMBA", "") == "1"
+
+    bot = CAPMBot(FM_ACCOUNT, FM_EMAIL, FM_PASSWORD, MARKETPLACE_ID,
+                  risk_aversion=RISK_AVERSION, target_variance=TARGET_VARIANCE, use_numba=USE_NUMBA)
     bot.run()
\ No newline at end of file